@@ -1,29 +1,39 @@
-import json
+import orjson
 import wave
+import struct
 import contextlib
 import string, re
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import jiwer
 from normalise import normalise, tokenize_basic
 
+# a literal "\x" escape and the (up to) two characters following it
+_HEX_RE = re.compile(r"\\x.{0,2}", re.DOTALL)
+_HAS_DIGIT = re.compile(r"\d")
+_PUNCT_TABLE = str.maketrans('', '', string.punctuation)
+_SUB_MAP = {"mister": "mr", "missus": "mrs"}
+# whole space-delimited words only, the same tokens split(" ") would produce
+_SUB_RE = re.compile(r"(?<![^ ])(?:mister|missus)(?![^ ])")
+_JIWER = jiwer.Compose([
+    jiwer.RemoveMultipleSpaces(),
+    jiwer.ExpandCommonEnglishContractions(),
+    jiwer.RemoveWhiteSpace(replace_by_space=True),  # must remove trailing space after it
+    jiwer.Strip(),
+])
+# canonical 44-byte PCM header: RIFF chunk, 16-byte fmt chunk, then the data chunk header
+_WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
 def remove_hex(text: str) -> str:
     """
     Example: 
     "\xe3\x80\x90Hello \xe3\x80\x91 World!"
     """
-    res = []
-    i = 0
-    while i < len(text):
-        if text[i] == "\\" and i+1 < len(text) and text[i+1] == "x":
-            i += 3
-            res.append(" ")
-        else:
-            res.append(text[i])
-        i += 1
-    return "".join(res)
+    return _HEX_RE.sub(" ", text)
 
 
 def remove_punctuation(text: str) -> str:
-    return text.translate(str.maketrans('', '', string.punctuation))
+    return text.translate(_PUNCT_TABLE)
 
 
 def normalize_text(text: str) -> str:
@@ -35,43 +45,46 @@ def substitute_word(text: str) -> str:
     """
     word subsitution to make it consistent
     """
-    words = text.split(" ")
-    preprocessed = []
-    for w in words:
-        substitution = ""
-        if w == "mister":
-            substitution = "mr"
-        elif w == "missus":
-            substitution = "mrs"
-        else:
-            substitution = w
-        preprocessed.append(substitution)
-    return " ".join(preprocessed)
+    return _SUB_RE.sub(lambda m: _SUB_MAP[m.group()], text)
 
 
+## prompts are shared between speakers, so identical transcripts repeat a lot
+@functools.lru_cache(maxsize=65536)
 def preprocess_text(text: str) -> str:
     text = text.lower()
     text = remove_hex(text)
     text = remove_punctuation(text)
 
     ## it takes long time to normalize
-    ## skip this first
-    try:
-        text = normalize_text(text)
-    except:
-        text = text
+    ## only numbers need expanding, so skip it for text without digits
+    if _HAS_DIGIT.search(text):
+        try:
+            text = normalize_text(text)
+        except Exception:
+            pass
+        ## normalise can put punctuation back
+        text = remove_punctuation(text)
 
-    text = remove_punctuation(text)
     text = substitute_word(text)
-    text = jiwer.RemoveMultipleSpaces()(text)
-    text = jiwer.ExpandCommonEnglishContractions()(text)
-    text = jiwer.RemoveWhiteSpace(replace_by_space=True)(
-        text)  # must remove trailing space after it
-    text = jiwer.Strip()(text)
+    text = _JIWER(text)
     return text
 
 
-def measure_audio_duration(filepath: str) -> int:
+def measure_audio_duration(filepath: str) -> float:
+    with open(filepath, 'rb') as f:
+        header = f.read(_WAV_HEADER.size)
+
+    ## read the duration straight from a canonical header,
+    ## let the wave module walk the chunks of anything else
+    if len(header) == _WAV_HEADER.size:
+        (riff, _, wave_id, fmt, fmt_size, audio_format, channels, rate,
+         _, _, bits, data, data_size) = _WAV_HEADER.unpack(header)
+        if (riff == b'RIFF' and wave_id == b'WAVE' and fmt == b'fmt ' and fmt_size == 16
+                and audio_format == 1 and data == b'data'
+                and channels > 0 and rate > 0 and bits > 0):
+            frames = data_size // (channels * ((bits + 7) // 8))
+            return frames / float(rate)
+
     with contextlib.closing(wave.open(filepath, 'r')) as f:
         frames = f.getnframes()
         rate = f.getframerate()
@@ -79,11 +92,19 @@ def measure_audio_duration(filepath: str) -> int:
     return duration
 
 
+def batch_measure_durations(filepaths: list, max_workers: int = 32) -> list:
+    """
+    measure_audio_duration over a whole dataset, keeping many header reads
+    in flight at once since the work is bound by storage latency
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(measure_audio_duration, filepaths))
+
+
 def write_json_data(filepath, data):
-    with open(filepath, 'w') as f:
-        for d in data:
-            json.dump(d, f)
-            f.write("\n")
+    ## stream the records through a 1MB buffer instead of holding the whole manifest
+    with open(filepath, 'wb', buffering=1 << 20) as f:
+        f.writelines(orjson.dumps(d) + b"\n" for d in data)
 
 if __name__ == "__main__":
 
@@ -1,13 +1,20 @@
 import os
 import glob
 import random
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import helpers
 
 
 def idx_to_file(idx):
-    return "/".join(idx.split("-")[:-1])
+    head, _, _ = idx.rpartition("-")
+    return head.replace("-", "/")
 
 
+def read_transcript(transcript_dir, file_id):
+    with open(os.path.join(transcript_dir, file_id + '.txt')) as f:
+        return f.readlines()[0]
+
 
 if __name__ == "__main__":
 
@@ -21,15 +28,16 @@ if __name__ == "__main__":
         transcript_dir = os.path.join(root_dir, "transcript")
         wav_dir = os.path.join(root_dir, "wav")
 
-        for filename in os.listdir(transcript_dir):
-            file_id = filename.split('.')[0]
+        file_ids = [entry.name.split('.')[0] for entry in os.scandir(transcript_dir) if entry.name.endswith('.txt')]
+        wav_paths = [os.path.join(wav_dir, file_id + '.wav') for file_id in file_ids]
 
-            # get text (transcript)
-            with open(os.path.join(transcript_dir, file_id + '.txt')) as f:
-                text = f.readlines()[0]
+        ## reading the files is I/O bound, so overlap the reads with a thread pool
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            texts = list(executor.map(partial(read_transcript, transcript_dir), file_ids))
+        durations = helpers.batch_measure_durations(wav_paths)
 
-            wav_path = os.path.join(wav_dir, file_id + '.wav')
-            data.append({"text": text, "audio_filepath": wav_path, "duration": helpers.measure_audio_duration(wav_path)})
+        data.extend({"text": text, "audio_filepath": wav_path, "duration": duration}
+                    for text, wav_path, duration in zip(texts, wav_paths, durations))
 
     
         random.seed(123456)
@@ -50,11 +58,11 @@ if __name__ == "__main__":
 
         lower = 0
         
-        for name, interval in [seed, dev, selection, test]:
+        for split_name, interval in [seed, dev, selection, test]:
             upper = lower + interval
             
             curr_data = data[lower:upper] 
-            helpers.write_json_data(f"{path_to_store}/{name}.json", curr_data)
+            helpers.write_json_data(f"{path_to_store}/{split_name}.json", curr_data)
             
             lower = upper
 
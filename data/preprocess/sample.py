@@ -1,13 +1,13 @@
 import os
-import json
 import random
+import orjson
 import helpers
 
 
 def format_data(data):
-    fmt_data = []
-    for d in data :
-        fmt_data.append(json.loads(d))
+    fmt_data = [None] * len(data)
+    for i, d in enumerate(data) :
+        fmt_data[i] = orjson.loads(d)
     return fmt_data
 
 
@@ -18,20 +18,24 @@ if __name__ == "__main__" :
     seeds = [1, 2, 3]
     numbers = [50, 100, 200]
     
-    file = open(selection_json_fpath)
-    instances = file.readlines() 
-    file.close()
+    ## keep the lines as bytes, orjson parses them without a decode step
+    with open(selection_json_fpath, 'rb') as file:
+        instances = file.read().split(b"\n")
+    if not instances[-1]:
+        instances.pop()
+
+    ## parse once, every sample below is a slice of the same records
+    instances = format_data(instances)
 
 
     ## random select for several seeds
     for seed in seeds :
-        random.seed(seed)
-        data = random.sample(instances, len(instances))
+        ## a full-length sample keeps the selections identical to the released manifests
+        data = random.Random(seed).sample(instances, len(instances))
         
         ## random select for vaious number of instances, 200, 400, 600
         for number in numbers :
             sample_data = data[:number]
-            sample_data = format_data(sample_data)
             folder_dir = f"/media/zyang/Error-Driven-ASR-Personalization/data/SVBI/manifests/train/random/{number}/seed_{seed}/"
             
             os.makedirs(folder_dir, exist_ok=True)
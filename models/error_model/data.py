@@ -109,7 +109,7 @@ def convert_phonemes_to_ids(phoneme_sequence):
 def load_phoneme_sequences(json_manifest_paths, remove_duplicates=True):
   sentences = []
   for json_path in json_manifest_paths:
-    with open(json_path) as f:
+    with open(json_path, encoding="utf-8") as f:
       lines = [line for line in f]
       data = Parallel(n_jobs=-1)(delayed(normalized_json_transcript)(line) for line in tqdm(lines, total=len(lines)))
       print(type(data))
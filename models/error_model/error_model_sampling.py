@@ -80,8 +80,8 @@ class ErrorModelSampler():
     self.json_file = json_file
     print('\tparsing json...')
     
-    self.sentences = [normalized_json_transcript(line) for line in open(self.json_file)]
-    self.json_lines = [line for line in open(self.json_file)]
+    self.sentences = [normalized_json_transcript(line) for line in open(self.json_file, encoding="utf-8")]
+    self.json_lines = [line for line in open(self.json_file, encoding="utf-8")]
     self.phone_sentences = []
 
     print('\tgenerating_vocab...')
@@ -163,7 +163,7 @@ class ErrorModelSampler():
 def dump_samples(samples,filename):
   output_dir = os.path.split(filename)[0]
   os.makedirs(output_dir,exist_ok=True)
-  with open(filename,'w') as f:
+  with open(filename,'w',encoding='utf-8') as f:
     for sample in samples:
       f.write(sample)
 
@@ -171,7 +171,7 @@ def get_samples(sampler,duration):
   return sampler.sample(duration)
 
 def get_json_duration(json_file):
-  return sum([json.loads(line.strip())['duration'] for line in open(json_file)])
+  return sum([json.loads(line.strip())['duration'] for line in open(json_file, encoding="utf-8")])
 
 def parse_args():
     parser = argparse.ArgumentParser(description='error model sampling')
@@ -191,7 +191,7 @@ def main(args):
   seed_json_file = args.seed_json_file
   random_json_path = args.random_json_path
   output_json_path = args.output_json_path
-  seed_samples = [line for line in open(seed_json_file)]
+  seed_samples = [line for line in open(seed_json_file, encoding="utf-8")]
   weights_file = args.error_model_weights
   exp_id = args.exp_id
   for num_samples in [50,100,200,500]:
@@ -15,6 +15,8 @@
 """
 This file contains classes and functions related to data loading
 """
+import inspect
+import random
 import torch
 import numpy as np
 import math
@@ -79,10 +81,41 @@ class DistributedBucketBatchSampler(Sampler):
     def set_epoch(self, epoch):
         self.epoch = epoch
 
+class DurationBatchSampler(Sampler):
+    def __init__(self, dataset, batch_size):
+        """Single process batch sampler that groups utterances of similar duration, so that batches padded
+        to their longest utterance carry little padding. Batches come in increasing duration order,
+        use restore_order() to put per-utterance results back in dataset order.
+
+        Args:
+            dataset: AudioDataset to sample from
+            batch_size: data batch size
+        """
+        durations = [sample['audio_duration'][0] for sample in dataset.manifest]
+        order = sorted(range(len(durations)), key=durations.__getitem__)
+        self.batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def restore_order(self, items):
+        """maps a list of per-utterance results, in the order they were sampled, back to dataset order"""
+        restored = [None] * len(items)
+        for item, index in zip(items, (index for batch in self.batches for index in batch)):
+            restored[index] = item
+        return restored
+
 class data_prefetcher():
-    def __init__(self, loader):
+    """stages the next batch on `device` on a side stream while the current one is being consumed.
+    Falls back to plain synchronous copies when `device` is not a GPU
+    """
+    def __init__(self, loader, device=torch.device("cuda")):
         self.loader = iter(loader)
-        self.stream = torch.cuda.Stream()
+        self.device = device
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
         self.preload()
 
     def preload(self):
@@ -91,19 +124,40 @@ class data_prefetcher():
         except StopIteration:
             self.next_input = None
             return
+        if self.stream is None:
+            self.next_input = [ x.to(self.device) for x in self.next_input]
+            return
         with torch.cuda.stream(self.stream):
-            self.next_input = [ x.cuda(non_blocking=True) for x in self.next_input]
+            self.next_input = [ x.to(self.device, non_blocking=True) for x in self.next_input]
 
-    def __next__(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
+    def next(self):
+        """returns the staged batch, None once the loader is exhausted"""
         input = self.next_input
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            if input is not None:
+                # the batch was allocated on the side stream, keep the allocator from reusing it early
+                for x in input:
+                    x.record_stream(current_stream)
         self.preload()
         return input
-    def next(self):
-        return self.__next__()
+    def __next__(self):
+        input = self.next()
+        if input is None:
+            raise StopIteration
+        return input
     def __iter__(self):
         return self
 
+def seed_worker(worker_id):
+    """seeds numpy and python's random in a DataLoader worker from the seed torch gave that worker,
+    otherwise forked workers all share the parent's numpy state
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
 def seq_collate_fn(batch):
     """batches samples and returns as tensors
     Args:
@@ -157,6 +211,9 @@ class AudioToTextDataLayer:
         trim_silence = kwargs.get('trim_silence', False)
         multi_gpu = kwargs.get('multi_gpu', False)
         sampler_type = kwargs.get('sampler', 'default')
+        num_workers = kwargs.get('num_workers', 4)
+        prefetch_factor = kwargs.get('prefetch_factor', 2)
+        batch_by_duration = kwargs.get('batch_by_duration', False)
         speed_perturbation = featurizer_config.get('speed_perturbation', False)
         sort_by_duration=sampler_type == 'bucket'
         self._featurizer = WaveformFeaturizer.from_config(featurizer_config, perturbation_configs=perturb_config)
@@ -172,7 +229,22 @@ class AudioToTextDataLayer:
 
         print('sort_by_duration', sort_by_duration)
 
-        if not multi_gpu:
+        loader_kwargs = dict(num_workers=num_workers, pin_memory=True, worker_init_fn=seed_worker)
+        # keep workers alive across epochs instead of re-forking them, and let each
+        # of them run prefetch_factor batches ahead (torch>=1.7, worker processes only)
+        if num_workers > 0 and 'persistent_workers' in inspect.signature(torch.utils.data.DataLoader).parameters:
+            loader_kwargs['persistent_workers'] = True
+            loader_kwargs['prefetch_factor'] = prefetch_factor
+
+        if not multi_gpu and batch_by_duration:
+            self.sampler = DurationBatchSampler(self._dataset, batch_size=batch_size)
+            self._dataloader = torch.utils.data.DataLoader(
+                dataset=self._dataset,
+                collate_fn=lambda b: seq_collate_fn(b),
+                **loader_kwargs,
+                batch_sampler=self.sampler
+            )
+        elif not multi_gpu:
             self.sampler = None
             self._dataloader = torch.utils.data.DataLoader(
                 dataset=self._dataset,
@@ -180,8 +252,7 @@ class AudioToTextDataLayer:
                 collate_fn=lambda b: seq_collate_fn(b),
                 drop_last=drop_last,
                 shuffle=shuffle if self.sampler is None else False,
-                num_workers=4,
-                pin_memory=True,
+                **loader_kwargs,
                 sampler=self.sampler
             )
         elif sampler_type == 'bucket':
@@ -190,8 +261,7 @@ class AudioToTextDataLayer:
             self._dataloader = torch.utils.data.DataLoader(
                 dataset=self._dataset,
                 collate_fn=lambda b: seq_collate_fn(b),
-                num_workers=4,
-                pin_memory=True,
+                **loader_kwargs,
                 batch_sampler=self.sampler
             )
         elif sampler_type == 'default':
@@ -203,8 +273,7 @@ class AudioToTextDataLayer:
                 collate_fn=lambda b: seq_collate_fn(b),
                 drop_last=drop_last,
                 shuffle=shuffle if self.sampler is None else False,
-                num_workers=4,
-                pin_memory=True,
+                **loader_kwargs,
                 sampler=self.sampler
             )
         else:
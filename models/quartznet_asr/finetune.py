@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import argparse
+import contextlib
+import inspect
 import itertools
 import os
 import time
@@ -21,14 +23,15 @@ import torch
 import random
 import numpy as np
 import math
-from dataset import AudioToTextDataLayer
+from dataset import AudioToTextDataLayer, data_prefetcher
 from helpers import monitor_asr_train_progress, process_evaluation_batch, process_evaluation_epoch,  \
                     add_ctc_labels, AmpOptimizations, model_multi_gpu, print_dict, \
-                    print_once, make_bn_layers_in_eval_mode
+                    print_once, make_bn_layers_in_eval_mode, autocast, inference_mode, strip_preprocessor_prefix
 from quartznet_model import AudioPreprocessing, CTCLossNM, GreedyCTCDecoder, Jasper
 from optimizers import Novograd, AdamW
 from torch.utils.tensorboard import SummaryWriter
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import pdb
 
@@ -40,36 +43,66 @@ def lr_policy(initial_lr, step, N):
     learning rate decay
     Args:
         initial_lr: base learning rate
-        step: current iteration number
+        step: current iteration number, or an array of them
         N: total number of iterations over which learning rate is decayed
     """
     min_lr = 1e-10
     res = initial_lr * ((N - step) / N) ** 2
-    return max(res, min_lr)
+    return np.maximum(res, min_lr)
 
 def warmup_decay_policy(initial_lr, step, N, warmup_portion=0.1):
+    """
+    linear warmup followed by linear decay, `step` may be an array of iteration numbers
+    """
     min_lr = 1e-10
-    step +=1 # 1 indexed
+    step = step + 1 # 1 indexed
     warmup_steps = math.floor(warmup_portion*N)
     remaining_steps = N - warmup_steps
 
-    if step <= warmup_steps:
-        return initial_lr * (step/warmup_steps)
-    else:
-        res = initial_lr * ((N-step)/remaining_steps)
-        return max(res,min_lr)
+    # both branches are evaluated, the max(..., 1) only keeps the unused one finite
+    return np.where(step <= warmup_steps,
+                    initial_lr * (step / max(warmup_steps, 1)),
+                    np.maximum(initial_lr * ((N - step) / max(remaining_steps, 1)), min_lr))
+
 
+# checkpoints are written by one background thread so training does not stall on disk I/O
+_save_executor = ThreadPoolExecutor(max_workers=1)
+_pending_save = None
+
+def _to_cpu(obj):
+    """recursively copies the tensors of a (possibly nested) state dict to cpu"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+def _write_checkpoint(checkpoint, path):
+    torch.save(checkpoint, path)
+    print_once('Saved.')
+
+def wait_for_pending_save():
+    """blocks until the last checkpoint handed to save() is on disk, re-raising any error it hit"""
+    global _pending_save
+    if _pending_save is not None:
+        _pending_save.result()
+        _pending_save = None
 
 def save(model, optimizer, epoch, output_dir, save_optimizer=True):
     """
-    Saves model checkpoint
+    Saves model checkpoint. The state is copied to cpu right away and written in the background,
+    call wait_for_pending_save() to make sure it reached the disk
     Args:
         model: model
         optimizer: optimizer
         epoch: epoch of model training
         output_dir: path to save model checkpoint
     """
+    global _pending_save
     os.makedirs(output_dir,exist_ok=True)
+    model = getattr(model, '_orig_mod', model)  # unwrap torch.compile, the checkpoint is named after the model class
     class_name = model.__class__.__name__
     unix_time = time.time()
     #file_name = "{0}_{1}-epoch-{2}.pt".format(class_name, unix_time, epoch)
@@ -77,14 +110,15 @@ def save(model, optimizer, epoch, output_dir, save_optimizer=True):
     print_once("Saving module {0} in {1}".format(class_name, os.path.join(output_dir, file_name)))
     if (not torch.distributed.is_initialized() or (torch.distributed.is_initialized() and torch.distributed.get_rank() == 0)):
         model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
+        # snapshot before returning, the optimizer keeps updating these tensors in place
         save_checkpoint={
                         'epoch': epoch,
-                        'state_dict': model_to_save.state_dict(),
-                        'optimizer': optimizer.state_dict() if save_optimizer else None
+                        'state_dict': _to_cpu(model_to_save.state_dict()),
+                        'optimizer': _to_cpu(optimizer.state_dict()) if save_optimizer else None
                         }
 
-        torch.save(save_checkpoint, os.path.join(output_dir, file_name))
-    print_once('Saved.')
+        wait_for_pending_save()
+        _pending_save = _save_executor.submit(_write_checkpoint, save_checkpoint, os.path.join(output_dir, file_name))
 
 
 
@@ -96,11 +130,11 @@ def train(
         ctc_loss,
         greedy_decoder,
         optimizer,
-        optim_level,
+        scaler,
         labels,
         multi_gpu,
         args,
-        fn_lr_policy=None,
+        lr_schedule=None,
         other_inputs=None,
         device=torch.device("cpu")):
     """Trains model
@@ -111,56 +145,42 @@ def train(
         ctc_loss: loss function
         greedy_decoder: greedy ctc decoder
         optimizer: optimizer
-        optim_level: AMP optimization level
+        scaler: AMP gradient scaler, None when training in fp32
         labels: list of output labels
         multi_gpu: true if multi gpu training
         args: script input argument list
-        fn_lr_policy: learning rate adjustment function
+        lr_schedule: array with the learning rate of every step, None keeps the optimizer's
     """
     def eval():
         """Evaluates model on evaluation dataset
         """
-        with torch.no_grad():
+        with inference_mode():
             _global_var_dict = {
                 'EvalLoss': [],
                 'predictions': [],
                 'transcripts': [],
             }
             eval_dataloader = data_layer_eval.data_iterator
+            model.eval()
             for data in eval_dataloader:
-                tensors = []
-                for d in data:
-                    if isinstance(d, torch.Tensor):
-                        tensors.append(d.to(device))
-                    else:
-                        tensors.append(d)
-                t_audio_signal_e, t_a_sig_length_e, t_transcript_e, t_transcript_len_e = tensors
+                t_audio_signal_e, t_a_sig_length_e, t_transcript_e, t_transcript_len_e = tuple(
+                    d.to(device, non_blocking=True) if torch.is_tensor(d) else d for d in data)
 
-                model.eval()
+                # feature extraction stays in fp32
+                t_processed_signal_e, t_processed_sig_length_e = audio_preprocessor(t_audio_signal_e, t_a_sig_length_e)
                 
-                if optim_level == 1:
-                  with amp.disable_casts():
-                      pass
-                    #   t_processed_signal_e, t_processed_sig_length_e = audio_preprocessor(t_audio_signal_e, t_a_sig_length_e) 
-                else:
-                  t_processed_signal_e, t_processed_sig_length_e = audio_preprocessor(t_audio_signal_e, t_a_sig_length_e)
-                
-                if jasper_encoder.use_conv_mask:
-                    t_log_probs_e, t_encoded_len_e = model.forward((t_processed_signal_e, t_processed_sig_length_e))
-                else:
-                    t_log_probs_e = model.forward(t_processed_signal_e)
+                with autocast(enabled=args.fp16):
+                    if use_conv_mask:
+                        t_log_probs_e, t_encoded_len_e = model.forward((t_processed_signal_e, t_processed_sig_length_e))
+                    else:
+                        t_log_probs_e = model.forward(t_processed_signal_e)
 
                 t_loss_e = ctc_loss(log_probs=t_log_probs_e, targets=t_transcript_e, input_length=t_encoded_len_e, target_length=t_transcript_len_e)
 
                 t_predictions_e = greedy_decoder(log_probs=t_log_probs_e)
 
-                values_dict = dict(
-                    loss=[t_loss_e],
-                    predictions=[t_predictions_e],
-                    transcript=[t_transcript_e],
-                    transcript_length=[t_transcript_len_e]
-                )
-                process_evaluation_batch(values_dict, _global_var_dict, labels=labels)
+                process_evaluation_batch(t_predictions_e, t_transcript_e, t_transcript_len_e, _global_var_dict,
+                                         labels=labels, loss=t_loss_e)
 
             # final aggregation across all workers and minibatches) and logging of results
             wer, cer, eloss = process_evaluation_epoch(_global_var_dict)
@@ -181,9 +201,20 @@ def train(
     step = epoch * args.step_per_epoch
     patience = 0
 
-    audio_preprocessor = model.module.audio_preprocessor if hasattr(model, 'module') else model.audio_preprocessor
-    data_spectr_augmentation = model.module.data_spectr_augmentation if hasattr(model, 'module') else model.data_spectr_augmentation
-    jasper_encoder = model.module.jasper_encoder if hasattr(model, 'module') else model.jasper_encoder
+    bare_model = model.module if hasattr(model, 'module') else model
+    is_ddp = hasattr(model, 'no_sync')
+    audio_preprocessor = bare_model.audio_preprocessor
+    data_spectr_augmentation = bare_model.data_spectr_augmentation
+    jasper_encoder = bare_model.jasper_encoder
+    use_conv_mask = jasper_encoder.use_conv_mask
+    # drop the grads instead of zero-filling them, where zero_grad supports it (torch>=1.7)
+    zero_grad_kwargs = {'set_to_none': True} if 'set_to_none' in inspect.signature(optimizer.zero_grad).parameters else {}
+
+    def train_mode():
+        """puts the model back in training mode, done per epoch and after each evaluation rather than per batch"""
+        model.train()
+        if args.turn_bn_eval:
+            make_bn_layers_in_eval_mode(jasper_encoder)
 
     print_once("Pre Evaluation ....................... ......  ... .. . .")
     prev_best_wer=10000
@@ -196,40 +227,35 @@ def train(
         print_once("Starting epoch {0}, step {1}".format(epoch, step))
         last_epoch_start = time.time()
         batch_counter = 0
-        average_loss = 0
-        for data in train_dataloader:
+        # summed on the device, only read back when it gets logged
+        loss_accum = torch.zeros((), device=device)
+        train_mode()
+        # batches arrive already on `device`, the copy of the next one overlapping this step
+        prefetcher = data_prefetcher(train_dataloader, device)
+        data = prefetcher.next()
+        while data is not None:
             #torch.cuda.empty_cache()
-            tensors = []
-            for d in data:
-                if isinstance(d, torch.Tensor):
-                    tensors.append(d.to(device))
-                else:
-                    tensors.append(d)
 
             if batch_counter == 0:
 
-                if fn_lr_policy is not None:
-                    adjusted_lr = fn_lr_policy(step)
+                if lr_schedule is not None:
+                    # past the end of the schedule (--num_steps) keep its last value
+                    adjusted_lr = float(lr_schedule[min(step, len(lr_schedule) - 1)])
                     for param_group in optimizer.param_groups:
                             param_group['lr'] = adjusted_lr
-                optimizer.zero_grad()
+                optimizer.zero_grad(**zero_grad_kwargs)
                 last_iter_start = time.time()
-            t_audio_signal_t, t_a_sig_length_t, t_transcript_t, t_transcript_len_t = tensors     
-            model.train()
-            if args.turn_bn_eval:
-                make_bn_layers_in_eval_mode(model.jasper_encoder)
-            if optim_level == 1:
-                pass
-            #   with amp.disable_casts():
-            #       t_processed_signal_t, t_processed_sig_length_t = audio_preprocessor(t_audio_signal_t, t_a_sig_length_t) 
-            else:
-              t_processed_signal_t, t_processed_sig_length_t = audio_preprocessor(t_audio_signal_t, t_a_sig_length_t)
+            t_audio_signal_t, t_a_sig_length_t, t_transcript_t, t_transcript_len_t = data
+            # feature extraction stays in fp32
+            t_processed_signal_t, t_processed_sig_length_t = audio_preprocessor(t_audio_signal_t, t_a_sig_length_t)
 
             t_processed_signal_t = data_spectr_augmentation(t_processed_signal_t)
-            if jasper_encoder.use_conv_mask:
-                t_log_probs_t, t_encoded_len_t = model.forward((t_processed_signal_t, t_processed_sig_length_t))
-            else:
-                t_log_probs_t = model.forward(t_processed_signal_t)
+            # log_softmax autocasts to fp32, so the CTC loss below is computed in fp32
+            with autocast(enabled=args.fp16):
+                if use_conv_mask:
+                    t_log_probs_t, t_encoded_len_t = model.forward((t_processed_signal_t, t_processed_sig_length_t))
+                else:
+                    t_log_probs_t = model.forward(t_processed_signal_t)
 
             t_loss_t = ctc_loss(log_probs=t_log_probs_t, 
                                 targets=t_transcript_t, 
@@ -240,24 +266,33 @@ def train(
             if args.gradient_accumulation_steps > 1:
                 t_total_loss = t_total_loss / args.gradient_accumulation_steps
 
-            if optim_level >=0 and optim_level <=3:
-                pass
-                # with amp.scale_loss(t_total_loss, optimizer) as scaled_loss:
-                #     scaled_loss.backward()
+            # only the last micro-batch of an accumulation group needs the DDP gradient allreduce
+            if is_ddp and (batch_counter + 1) % args.gradient_accumulation_steps != 0:
+                sync_ctx = model.no_sync()
             else:
-                t_total_loss.backward()
+                sync_ctx = contextlib.nullcontext()
+            with sync_ctx:
+                if scaler is not None:
+                    scaler.scale(t_total_loss).backward()
+                else:
+                    t_total_loss.backward()
             batch_counter += 1
-            average_loss += t_total_loss.item()
+            loss_accum += t_total_loss.detach()
 
             #pdb.set_trace()
             if batch_counter % args.gradient_accumulation_steps == 0:
-                optimizer.step()
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
                 #print()
 
                 if step % args.train_frequency == 0:
                     t_predictions_t = greedy_decoder(log_probs=t_log_probs_t)
                     e_tensors = [t_predictions_t, t_transcript_t, t_transcript_len_t]
                     train_wer, train_wer_list = monitor_asr_train_progress(e_tensors, labels=labels)
+                    average_loss = loss_accum.item()
                     print_once("Loss@Step: {0}  ::::::: {1}".format(step, str(average_loss)))
                     print_once("Step time: {0} seconds".format(time.time() - last_iter_start))
                     other_inputs["summary_writer"].add_scalar('Loss/train', average_loss, step)
@@ -266,6 +301,7 @@ def train(
                     if args.save_after_each_epoch == False:
                         print_once("Doing Evaluation ....................... ......  ... .. . .")
                         e_wer,e_loss = eval()
+                        train_mode()
                         other_inputs["summary_writer"].add_scalar('Loss/eval',e_loss,step)
                         other_inputs["summary_writer"].add_scalar('WER/eval',e_wer,step)
                         if prev_best_wer is None or e_wer < prev_best_wer:
@@ -276,9 +312,10 @@ def train(
                             pass
                 step += 1
                 batch_counter = 0
-                average_loss = 0
+                loss_accum.zero_()
                 if args.num_steps is not None and step >= args.num_steps:
                     break
+            data = prefetcher.next()
 
         if args.num_steps is not None and step >= args.num_steps:
             break
@@ -321,7 +358,6 @@ def main(args):
     torch.manual_seed(args.seed)
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     #assert(torch.cuda.is_available())
-    torch.backends.cudnn.benchmark = args.cudnn
     # set up distributed training
     if args.local_rank is not None:
         torch.cuda.set_device(args.local_rank)
@@ -347,6 +383,8 @@ def main(args):
     featurizer_config_eval["optimization_level"] = optim_level
 
     sampler_type = featurizer_config.get("sampler", 'default')
+    # the bucket sampler only produces a bounded set of input shapes, so autotuning pays off
+    torch.backends.cudnn.benchmark = args.cudnn or sampler_type == 'bucket'
     perturb_config = jasper_model_definition.get('perturb', None)
     if args.pad_to_max:
         assert(args.max_duration > 0)
@@ -363,6 +401,11 @@ def main(args):
     if args.batch_size % args.gradient_accumulation_steps != 0:
         raise ValueError('gradient accumulation step {} is not divisible by batch size {}'.format(args.gradient_accumulation_steps, args.batch_size))
 
+    if args.pad_to is not None and not args.pad_to_max:
+        # coarser padding bounds the number of distinct input shapes cudnn benchmark has to tune for
+        featurizer_config['pad_to'] = args.pad_to
+        featurizer_config_eval['pad_to'] = args.pad_to
+
     if args.min_duration is not None:
         featurizer_config['min_duration'] = args.min_duration
         featurizer_config_eval['min_duration'] = args.min_duration
@@ -377,7 +420,9 @@ def main(args):
                                     batch_size=args.batch_size // args.gradient_accumulation_steps,
                                     multi_gpu=multi_gpu,
                                     pad_to_max=args.pad_to_max,
-                                    sampler=sampler_type
+                                    sampler=sampler_type,
+                                    num_workers=args.num_workers,
+                                    prefetch_factor=args.prefetch_factor
                                     )
 
     data_layer_eval = AudioToTextDataLayer(
@@ -388,7 +433,9 @@ def main(args):
                                     batch_size=args.batch_size,
                                     multi_gpu=multi_gpu,
                                     pad_to_max=args.pad_to_max,
-                                    shuffle=False
+                                    shuffle=False,
+                                    num_workers=args.num_workers,
+                                    prefetch_factor=args.prefetch_factor
                                     )
 
     jasper_model_definition['turn_bn_eval']=args.turn_bn_eval
@@ -404,11 +451,7 @@ def main(args):
     if args.ckpt is not None:
         print_once("loading model from {}".format(args.ckpt))
         checkpoint = torch.load(args.ckpt, map_location="cpu")
-        for k in audio_preprocessor.state_dict().keys():
-            #print(k)
-            #if k not in checkpoint['state_dict']:
-                #print("\taudio_preprocessor." + k)
-            checkpoint['state_dict'][k] = checkpoint['state_dict'].pop("audio_preprocessor." + k)
+        checkpoint['state_dict'] = strip_preprocessor_prefix(checkpoint['state_dict'], audio_preprocessor)
         model.load_state_dict(checkpoint['state_dict'], strict=False)
         
         if args.resume_from_ckpt:
@@ -433,6 +476,18 @@ def main(args):
     print_once("Number of parameters in encoder: {0}".format(model.jasper_encoder.num_weights()))
     print_once("Number of parameters in decode: {0}".format(model.jasper_decoder.num_weights()))
 
+    # script encoder/decoder to cut per-layer python dispatch; make_bn_layers_in_eval_mode
+    # needs the eager JasperBlock modules, so it can not be combined with --turn_bn_eval
+    if args.torchscript:
+        if args.turn_bn_eval or args.compile:
+            raise ValueError("--torchscript can not be combined with --turn_bn_eval or --compile")
+        try:
+            jasper_encoder = torch.jit.script(model.jasper_encoder)
+            jasper_decoder = torch.jit.script(model.jasper_decoder)
+            model.jasper_encoder, model.jasper_decoder = jasper_encoder, jasper_decoder
+        except (torch.jit.frontend.NotSupportedError, RuntimeError) as e:
+            print_once("WARNING: TorchScript compilation of the encoder/decoder failed, running eager:\n{0}".format(e))
+
     N = len(data_layer)
     if sampler_type == 'default':
         args.step_per_epoch = math.ceil(N / (args.batch_size * (1 if not torch.distributed.is_initialized() else torch.distributed.get_world_size())))
@@ -444,12 +499,14 @@ def main(args):
     print_once('Have {0} steps / (gpu * epoch).'.format(args.step_per_epoch))
     print_once('-----------------')
 
+    # the per-step learning rates are computed once up front
+    total_steps = args.num_epochs * args.step_per_epoch
     if args.lr_decay == 'decay':
-        fn_lr_policy = lambda s: lr_policy(args.lr, s, args.num_epochs * args.step_per_epoch)
+        lr_schedule = lr_policy(args.lr, np.arange(total_steps), total_steps)
     elif args.lr_decay == 'warmup':
-        fn_lr_policy = lambda s: warmup_decay_policy(args.lr, s, args.num_epochs * args.step_per_epoch)
+        lr_schedule = warmup_decay_policy(args.lr, np.arange(total_steps), total_steps)
     else:
-        fn_lr_policy = None
+        lr_schedule = None
 
 
     model.to(device)
@@ -473,14 +530,18 @@ def main(args):
         raise ValueError("invalid optimizer choice: {}".format(args.optimizer_kind))
 
 
-    if optim_level >= 0 and optim_level <=3:
-        pass
-        # model, optimizer = amp.initialize(
-        #     min_loss_scale=1.0,
-        #     models=model,
-        #     optimizers=optimizer,
-        #     opt_level=AmpOptimizations[optim_level])
+    if args.fp16:
+        if not hasattr(torch.cuda, 'amp'):
+            raise ValueError("--fp16 needs native AMP (torch.cuda.amp, torch>=1.6)")
+        scaler = torch.cuda.amp.GradScaler()
+    else:
+        scaler = None
     model = model_multi_gpu(model, multi_gpu)
+    if args.compile:
+        if not hasattr(torch, 'compile'):
+            raise ValueError("--compile needs torch.compile (torch>=2.0)")
+        # dynamic shapes, the sequence length changes from batch to batch
+        model = torch.compile(model, dynamic=True)
 
     if args.ckpt is not None and args.load_optimizer_state:
         optimizer.load_state_dict(checkpoint['optimizer'])
@@ -488,20 +549,24 @@ def main(args):
     
 
     os.makedirs(os.path.join(args.output_dir,"runs"),exist_ok=True)
-    summary_writer = SummaryWriter(log_dir=os.path.join(args.output_dir,"runs"))
+    # events are queued in memory and written by the writer's background thread
+    summary_writer = SummaryWriter(log_dir=os.path.join(args.output_dir,"runs"), max_queue=1000, flush_secs=60)
     other_inputs["summary_writer"]=summary_writer
 
     train(data_layer, data_layer_eval, model, \
           ctc_loss=ctc_loss, \
           greedy_decoder=greedy_decoder, \
           optimizer=optimizer, \
+          scaler=scaler, \
           labels=ctc_vocab, \
-          optim_level=optim_level, \
           multi_gpu=multi_gpu, \
-          fn_lr_policy=fn_lr_policy, \
+          lr_schedule=lr_schedule, \
           args=args, \
           other_inputs=other_inputs,
           device=device)
+    wait_for_pending_save()
+    summary_writer.close()
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Jasper')
@@ -521,11 +586,16 @@ def parse_args():
     parser.add_argument("--max_duration", type=float, help='maximum duration of audio samples for training and evaluation')
     parser.add_argument("--min_duration", type=float, default=None, help='minimum duration of audio samples for training and evaluation')
     parser.add_argument("--pad_to_max", action="store_true", default=False, help="pad sequence to max_duration")
+    parser.add_argument("--pad_to", type=int, default=None, help="pad feature frames to a multiple of this, overrides the model config (e.g. 64 with --cudnn)")
     parser.add_argument("--gradient_accumulation_steps", default=1, type=int, help='number of accumulation steps')
     parser.add_argument("--optimizer", dest="optimizer_kind", default="novograd", type=str, help='optimizer')
     parser.add_argument("--lr_decay", type=str, default='none', choices=['warmup','decay','none'], help='learning rate decay strategy')
     parser.add_argument("--cudnn", action="store_true", default=False, help="enable cudnn benchmark")
     parser.add_argument("--fp16", action="store_true", default=False, help="use mixed precision training")
+    parser.add_argument("--compile", action="store_true", default=False, help="compile the model with torch.compile")
+    parser.add_argument("--torchscript", action="store_true", default=False, help="script the encoder and decoder with torch.jit.script")
+    parser.add_argument("--num_workers", default=min(8, os.cpu_count() or 1), type=int, help='number of data loading worker processes')
+    parser.add_argument("--prefetch_factor", default=4, type=int, help='number of batches loaded in advance by each worker')
     parser.add_argument("--output_dir", type=str, required=True, help='saves results in this directory')
     parser.add_argument("--best_dir", type=str, required=True, help='saves the best ckpt in this directory')
     parser.add_argument("--ckpt", default=None, type=str, help="path to load a pre-trained ckpt")
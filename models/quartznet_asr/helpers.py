@@ -18,6 +18,7 @@ import torch.distributed as dist
 from enum import Enum
 from metrics import word_error_rate, f_wer, f_cer
 import json
+import contextlib
 
 import multiprocessing
 cpu_count = multiprocessing.cpu_count()
@@ -30,6 +31,26 @@ import pdb
 
 AmpOptimizations = ["O0", "O1", "O2", "O3"]
 
+def autocast(enabled=True, dtype=None):
+    """
+    native AMP autocast context. A disabled context is a plain no-op, so fp32
+    runs keep working on torch builds that predate torch.cuda.amp.
+    dtype (e.g. torch.bfloat16) defaults to fp16
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    if dtype is None:
+        return torch.cuda.amp.autocast()
+    return torch.cuda.amp.autocast(dtype=dtype)
+
+def inference_mode():
+    """
+    torch.inference_mode where available (torch>=1.9), torch.no_grad otherwise
+    """
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
 def print_once(msg):
     if (not torch.distributed.is_initialized() or (torch.distributed.is_initialized() and torch.distributed.get_rank() == 0)):
         print(msg)
@@ -51,20 +72,17 @@ def __ctc_decoder_predictions_tensor(tensor, labels):
         prediction
     """
     blank_id = len(labels) - 1
+    tensor = tensor.long()
+    # CTC decoding procedure, on the tensor's device: a frame is kept when it is not blank and
+    # differs from the previous frame (the frame before the first one counts as blank)
+    previous = torch.cat([tensor.new_full((tensor.shape[0], 1), blank_id), tensor[:, :-1]], dim=1)
+    keep = (tensor != blank_id) & (tensor != previous)
+    prediction_cpu_tensor = tensor.cpu()
+    keep_cpu = keep.cpu()
     hypotheses = []
-    labels_map = dict([(i, labels[i]) for i in range(len(labels))])
-    prediction_cpu_tensor = tensor.long().cpu()
     # iterate over batch
-    for ind in range(prediction_cpu_tensor.shape[0]):
-        prediction = prediction_cpu_tensor[ind].numpy().tolist()
-        # CTC decoding procedure
-        decoded_prediction = []
-        previous = len(labels) - 1 # id of a blank symbol
-        for p in prediction:
-            if (p != previous or previous == blank_id) and p != blank_id:
-                decoded_prediction.append(p)
-            previous = p
-        hypothesis = ''.join([labels_map[c] for c in decoded_prediction])
+    for prediction, mask in zip(prediction_cpu_tensor, keep_cpu):
+        hypothesis = ''.join([labels[c] for c in prediction[mask].tolist()])
         hypotheses.append(hypothesis)
     return hypotheses
 
@@ -105,10 +123,6 @@ def monitor_asr_train_progress(tensors: list, labels: list, do_print=True):
     return wer,wer_list
 
 
-def __gather_losses(losses_list: list) -> list:
-    return [torch.mean(torch.stack(losses_list))]
-
-
 def __gather_predictions(predictions_list: list, labels: list) -> list:
     results = []
     for prediction in predictions_list:
@@ -146,32 +160,34 @@ def convert_to_strings(out, seq_len,vocab):
         results.append(utterances)
     return results
 
-def process_evaluation_batch(tensors: dict, global_vars: dict, labels: list):
+def __as_list(x) -> list:
+    return x if isinstance(x, (list, tuple)) else [x]
+
+
+def process_evaluation_batch(predictions, transcript, transcript_length, global_vars: dict, labels: list,
+                             loss=None, logits=None, encoded_length=None):
     """
     Processes results of an iteration and saves it in global_vars
     Args:
-        tensors: dictionary with results of an evaluation iteration, e.g. loss, predictions, transcript, and output
+        predictions: predictions tensor of a batch, or a list of them for several batches
+        transcript: transcript tensor(s) matching predictions
+        transcript_length: transcript length tensor(s) matching predictions
         global_vars: dictionary where processes results of iteration are saved
         labels: A list of labels
+        loss: optional loss tensor of the iteration
+        logits: optional output tensor(s), kept in global_vars['logits']
+        encoded_length: optional encoded length tensor(s), kept in global_vars['encoded_lens']
     """
-    for kv, v in tensors.items():
-        if kv.startswith('loss'):
-            global_vars['EvalLoss'] += __gather_losses(v)
-        elif kv.startswith('predictions'):
-            global_vars['predictions'] += __gather_predictions(v, labels=labels)
-        elif kv.startswith('transcript_length'):
-            transcript_len_list = v
-        elif kv.startswith('transcript'):
-            transcript_list = v
-        elif kv.startswith('output'):
-            logits_list = v
-            global_vars['logits'] += v
-        elif kv.startswith('encoded_length'):
-            encoded_len_list = v
-            global_vars['encoded_lens'] += v
-
-    character_transcripts = __gather_transcripts(transcript_list,
-                                           transcript_len_list,
+    if loss is not None:
+        global_vars['EvalLoss'].append(loss)
+    global_vars['predictions'] += __gather_predictions(__as_list(predictions), labels=labels)
+    if logits is not None:
+        global_vars['logits'] += __as_list(logits)
+    if encoded_length is not None:
+        global_vars['encoded_lens'] += __as_list(encoded_length)
+
+    character_transcripts = __gather_transcripts(__as_list(transcript),
+                                           __as_list(transcript_length),
                                            labels=labels)
     global_vars['transcripts'] += character_transcripts
 
@@ -193,25 +209,23 @@ def process_evaluation_epoch(global_vars: dict, tag=None):
     references = global_vars['transcripts']
 
     wer, wer_list, scores, num_words = word_error_rate(hypotheses=hypotheses, references=references)
-    cer, _,_,_ = word_error_rate(hypotheses=hypotheses, references=references, use_cer=True)
+    cer, _, char_scores, num_chars = word_error_rate(hypotheses=hypotheses, references=references, use_cer=True)
     multi_gpu = torch.distributed.is_initialized()
     if multi_gpu:
+        # every rank evaluated its own shard: sum all the counts in a single all_reduce,
+        # so the ranks agree on WER and CER (and on early stopping)
+        totals = [scores, num_words, char_scores, num_chars]
         if eloss is not None:
-            eloss /= torch.distributed.get_world_size()
-            eloss_tensor = torch.tensor(eloss).cuda()
-            dist.all_reduce(eloss_tensor)
-            eloss = eloss_tensor.item()
-            del eloss_tensor
-
-        scores_tensor = torch.tensor(scores).cuda()
-        dist.all_reduce(scores_tensor)
-        scores = scores_tensor.item()
-        del scores_tensor
-        num_words_tensor = torch.tensor(num_words).cuda()
-        dist.all_reduce(num_words_tensor)
-        num_words = num_words_tensor.item()
-        del num_words_tensor
+            totals.append(eloss / torch.distributed.get_world_size())
+        totals_tensor = torch.tensor(totals, dtype=torch.float64).cuda()
+        dist.all_reduce(totals_tensor)
+        totals = totals_tensor.tolist()
+        del totals_tensor
+        scores, num_words, char_scores, num_chars = totals[:4]
+        if eloss is not None:
+            eloss = totals[4]
         wer = scores *1.0/num_words
+        cer = char_scores *1.0/num_chars
     return wer, cer, eloss
 
 
@@ -232,6 +246,20 @@ def print_dict(d):
 
 
 
+def strip_preprocessor_prefix(state_dict: dict, audio_preprocessor, prefix="audio_preprocessor.") -> dict:
+    """
+    Renames the "audio_preprocessor." keys of a checkpoint state dict to the keys of audio_preprocessor itself.
+    Keys the checkpoint does not have (e.g. buffers added after it was saved) are left to load_state_dict(strict=False)
+    Args:
+        state_dict: checkpoint state dict
+        audio_preprocessor: AudioPreprocessing module the keys are renamed for
+    Returns:
+        renamed state dict
+    """
+    pre_keys = set(audio_preprocessor.state_dict().keys())
+    return {(k[len(prefix):] if k.startswith(prefix) and k[len(prefix):] in pre_keys else k): v
+            for k, v in state_dict.items()}
+
 def model_multi_gpu(model, multi_gpu=False):
     if multi_gpu:
         # model = DDP(model)
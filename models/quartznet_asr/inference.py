@@ -18,8 +18,9 @@ from typing import List
 from tqdm import tqdm
 import math
 import toml
-from dataset import AudioToTextDataLayer
-from helpers import process_evaluation_batch, process_evaluation_epoch, add_ctc_labels, AmpOptimizations, print_dict, model_multi_gpu, print_sentence_wise_wer
+from dataset import AudioToTextDataLayer, data_prefetcher
+from helpers import process_evaluation_batch, process_evaluation_epoch, add_ctc_labels, AmpOptimizations, print_dict, model_multi_gpu, print_sentence_wise_wer, \
+                    autocast, inference_mode, strip_preprocessor_prefix
 from quartznet_model import AudioPreprocessing, GreedyCTCDecoder, JasperEncoderDecoder
 from parts.features import audio_from_file
 import torch
@@ -27,6 +28,8 @@ import torch.nn as nn
 import random
 import numpy as np
 import pickle
+import sys
+import tempfile
 import time
 import os
 
@@ -44,23 +47,174 @@ def parse_args():
     parser.add_argument("--ckpt", default=None, type=str, required=True, help='path to model checkpoint')
     parser.add_argument("--max_duration", default=None, type=float, help='maximum duration of sequences. if None uses attribute from model configuration file')
     parser.add_argument("--pad_to", default=None, type=int, help="default is pad to value as specified in model configurations. if -1 pad to maximum duration. If > 0 pad batch to next multiple of value")
-    parser.add_argument("--fp16", action='store_true', help='use half precision')
+    parser.add_argument("--fp16", action='store_true', help='use mixed precision (native AMP autocast)')
+    parser.add_argument("--bf16", action='store_true', help='use mixed precision with bfloat16 (native AMP autocast, Ampere or newer)')
     parser.add_argument("--pyt_fp16", action='store_true', help='use half precision')
-    parser.add_argument("--cudnn_benchmark", action='store_true', help="enable cudnn benchmark")
+    parser.add_argument("--compile", action='store_true', help="compile the encoder and decoder with torch.compile")
+    parser.add_argument("--cuda_graphs", action='store_true', help="replay the encoder and decoder from CUDA graphs captured per batch shape, use with a coarse --pad_to")
+    parser.add_argument("--cuda_graphs_max", default=16, type=int, help="maximum number of batch shapes captured with --cuda_graphs, other shapes run eagerly")
+    parser.add_argument("--int8", action='store_true', help="run the encoder and decoder as a post-training int8 quantized ONNX model in onnxruntime")
+    parser.add_argument("--int8_calib_batches", default=8, type=int, help="number of batches used to calibrate the int8 activation ranges")
+    parser.add_argument("--cudnn_benchmark", action='store_true', default=True, help="enable cudnn benchmark (default, the first batches of each new shape are slower while it tunes)")
+    parser.add_argument("--no_cudnn_benchmark", dest="cudnn_benchmark", action='store_false', help="disable cudnn benchmark")
     parser.add_argument("--save_prediction", type=str, default=None, help="if specified saves predictions in text form at this location")
     parser.add_argument("--logits_save_to", default=None, type=str, help="if specified will save logits to path")
+    parser.add_argument("--logits_memmap", action='store_true', help="save logits as a float16 memmap cut to the encoded lengths, plus a .idx file of (offset, length) rows, instead of a pickle")
     parser.add_argument("--seed", default=42, type=int, help='seed')
     parser.add_argument("--masked_fill", type="bool", help="Overrides the masked_fill option for the Encoder")
     parser.add_argument("--output_file",default="out.txt",type=str)
     parser.add_argument("--dump_file",default=None,type=str)
+    parser.add_argument("--no_batch_by_duration", dest="batch_by_duration", action='store_false', help="batch utterances in manifest order instead of grouping similar durations")
+    parser.add_argument("--num_workers", default=max(1, (os.cpu_count() or 2) // 2), type=int, help='number of data loading worker processes')
+    parser.add_argument("--prefetch_factor", default=4, type=int, help='number of batches loaded in advance by each worker')
     return parser.parse_args()
 
+class GraphedInfer:
+    """Runs encoderdecoder.infer by replaying CUDA graphs, one captured per input shape. All graphs share
+    one memory pool. Batch shapes are whatever the data layer produces, so this pays off when they repeat,
+    e.g. duration batching with a coarse --pad_to. At most max_graphs shapes are captured, batches of any
+    other shape run eagerly
+    """
+    def __init__(self, encoderdecoder, warmup_iters=3, max_graphs=16):
+        self.encoderdecoder = encoderdecoder
+        self.warmup_iters = warmup_iters
+        self.max_graphs = max_graphs
+        self.graphs = {}
+        self.pool = None
+
+    def _capture(self, signal, length):
+        static_signal = signal.clone()
+        static_length = length.clone()
+        # autocast must not hand cached casts from outside the graph to the captured kernels
+        amp = dict(enabled=torch.is_autocast_enabled(), dtype=torch.get_autocast_gpu_dtype(), cache_enabled=False)
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream), torch.cuda.amp.autocast(**amp):
+            for _ in range(self.warmup_iters):
+                self.encoderdecoder.infer((static_signal, static_length))
+        torch.cuda.current_stream().wait_stream(side_stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool), torch.cuda.amp.autocast(**amp):
+            static_out = self.encoderdecoder.infer((static_signal, static_length))
+        self.pool = graph.pool()
+        return graph, static_signal, static_length, static_out
+
+    def infer(self, x):
+        signal, length = x
+        key = (signal.shape, signal.dtype, torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype())
+        if key not in self.graphs:
+            if len(self.graphs) >= self.max_graphs:
+                return self.encoderdecoder.infer(x)
+            self.graphs[key] = self._capture(signal, length)
+        graph, static_signal, static_length, static_out = self.graphs[key]
+        static_signal.copy_(signal)
+        static_length.copy_(length)
+        graph.replay()
+        # the next replay overwrites the static outputs
+        return tuple(t.clone() for t in static_out)
+
+class _CalibrationReader:
+    """feeds the calibration batches to onnxruntime.quantization.quantize_static"""
+    def __init__(self, feeds):
+        self.feeds = iter(feeds)
+
+    def get_next(self):
+        return next(self.feeds, None)
+
+_ORT_TO_TORCH_DTYPE = {'tensor(float)': torch.float32, 'tensor(float16)': torch.float16, 'tensor(double)': torch.float64,
+                       'tensor(int32)': torch.int32, 'tensor(int64)': torch.int64}
+
+class OnnxInt8Infer:
+    """Runs encoderdecoder.infer from an int8 (QDQ) quantized ONNX export in onnxruntime. Activation
+    ranges are calibrated on batches spread over the data layer. Needs the TensorRT execution provider
+    for int8 kernels on the GPU, the CUDA provider runs the quantize/dequantize pairs in higher precision.
+    On the GPU providers inputs and outputs are bound to the torch tensors' device memory
+    """
+    input_names = ['features', 'features_len']
+    output_names = ['log_probs', 'encoded_len']
+
+    def __init__(self, encoderdecoder, audio_processor, data_layer, calib_batches=8):
+        import onnxruntime
+        from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+
+        sampler = data_layer.sampler
+        if sampler is not None and hasattr(sampler, 'batches'):
+            # duration batches come shortest first, take them strided so calibration covers long utterances too
+            loader = data_layer.data_iterator
+            stride = max(1, len(sampler.batches) // calib_batches)
+            calib_data = (loader.collate_fn([loader.dataset[i] for i in batch])
+                          for batch in sampler.batches[::stride][:calib_batches])
+        else:
+            calib_data = itertools.islice(data_layer.data_iterator, calib_batches)
+
+        with torch.no_grad():
+            calib = []
+            for data in calib_data:
+                features = audio_processor(data[0].cuda(), data[1].cuda())
+                calib.append(tuple(t.cpu().numpy() for t in features))
+
+        # the exports are only needed until the session has loaded the quantized model
+        with tempfile.TemporaryDirectory(prefix='quartznet_int8_') as work_dir:
+            fp32_path = os.path.join(work_dir, 'encoderdecoder.onnx')
+            int8_path = os.path.join(work_dir, 'encoderdecoder.int8.onnx')
+            with torch.no_grad():
+                torch.onnx.export(encoderdecoder, (tuple(torch.from_numpy(t).cuda() for t in calib[0]),), fp32_path,
+                                  input_names=self.input_names, output_names=self.output_names,
+                                  dynamic_axes={'features': {0: 'batch', 2: 'time'}, 'features_len': {0: 'batch'},
+                                                'log_probs': {0: 'batch', 1: 'time'}, 'encoded_len': {0: 'batch'}},
+                                  opset_version=13)
+                # output buffers for the GPU providers: the time axis shrinks by the encoder's total stride
+                log_probs, _ = encoderdecoder.infer(tuple(torch.from_numpy(t).cuda() for t in calib[0]))
+                self.time_stride = round(calib[0][0].shape[2] / log_probs.shape[1])
+                self.num_classes = log_probs.shape[2]
+
+            calibration_reader = _CalibrationReader([dict(zip(self.input_names, c)) for c in calib])
+            quantize_static(fp32_path, int8_path, calibration_reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+
+            # TensorRT builds an engine per input shape, a coarse --pad_to keeps the number of shapes down
+            providers = [p for p in ('TensorrtExecutionProvider', 'CUDAExecutionProvider', 'CPUExecutionProvider')
+                         if p in onnxruntime.get_available_providers()]
+            self.session = onnxruntime.InferenceSession(int8_path, providers=providers)
+        self.io_binding = self.session.get_providers()[0] != 'CPUExecutionProvider'
+        self.output_dtypes = [_ORT_TO_TORCH_DTYPE[o.type] for o in self.session.get_outputs()]
+
+        # the batch axis has to be dynamic, the last batch of a manifest is usually smaller than the export batch
+        features, features_len = calib[0]
+        try:
+            self.session.run(self.output_names, {'features': np.concatenate([features, features]),
+                                                 'features_len': np.concatenate([features_len, features_len])})
+        except Exception as e:
+            raise RuntimeError("the int8 model does not run on a batch size other than the export batch size "
+                               "({})".format(features.shape[0])) from e
+
+    def infer(self, x):
+        signal, length = x
+        if not self.io_binding:
+            log_probs, encoded_len = self.session.run(self.output_names, {'features': signal.cpu().numpy(),
+                                                                          'features_len': length.cpu().numpy()})
+            return torch.from_numpy(log_probs).to(signal.device), torch.from_numpy(encoded_len).to(signal.device)
+
+        signal, length = signal.contiguous(), length.contiguous()
+        batch, time = signal.size(0), -(-signal.size(2) // self.time_stride)
+        log_probs = torch.empty((batch, time, self.num_classes), dtype=self.output_dtypes[0], device=signal.device)
+        encoded_len = torch.empty((batch,), dtype=self.output_dtypes[1], device=signal.device)
+        binding = self.session.io_binding()
+        for name, t in zip(self.input_names + self.output_names, (signal, length, log_probs, encoded_len)):
+            bind = binding.bind_input if name in self.input_names else binding.bind_output
+            bind(name, 'cuda', t.device.index or 0, np.dtype(str(t.dtype)[len('torch.'):]), tuple(t.shape), t.data_ptr())
+        # onnxruntime runs on its own stream, the inputs have to be ready
+        torch.cuda.current_stream().synchronize()
+        self.session.run_with_iobinding(binding)
+        return log_probs, encoded_len
+
 def calc_wer(data_layer, audio_processor, 
              encoderdecoder, greedy_decoder, 
              labels, args):
 
     encoderdecoder = encoderdecoder.module if hasattr(encoderdecoder, 'module') else encoderdecoder
-    with torch.no_grad():
+    amp_dtype = torch.bfloat16 if args.bf16 else None
+    with inference_mode():
         # reset global_var_dict - results of evaluation will be stored there
         _global_var_dict = {
             'predictions': [],
@@ -69,31 +223,43 @@ def calc_wer(data_layer, audio_processor,
             'encoded_lens': [],
         }
 
-        # Evaluation mini-batch for loop
-        for it, data in enumerate(tqdm(data_layer.data_iterator)):
-
-            tensors = []
-            for d in data:
-                tensors.append(d.cuda())
+        # Evaluation mini-batch for loop. The next batch is copied to the GPU on a side stream
+        # (from pinned memory) while the current one is being evaluated
+        # per batch results stay on the GPU and are decoded on the host once the loop is done,
+        # so the loop itself never waits on a device-to-host copy
+        predictions, transcripts, transcript_lens, logits, encoded_lens = [], [], [], [], []
+        # logits are only needed when they get saved, otherwise don't hold on to [B, T, V] per batch
+        keep_logits = args.logits_save_to is not None
+        dataloader = data_layer.data_iterator
+        prefetcher = data_prefetcher(dataloader, torch.device("cuda"))
+        # throttled progress bar, and none at all when stderr goes to a log file
+        for it, data in enumerate(tqdm(prefetcher, total=len(dataloader), mininterval=0.5, disable=not sys.stderr.isatty())):
 
-            t_audio_signal_e, t_a_sig_length_e, t_transcript_e, t_transcript_len_e = tensors
+            t_audio_signal_e, t_a_sig_length_e, t_transcript_e, t_transcript_len_e = data
     
             t_processed_signal,t_processed_signal_len = audio_processor(t_audio_signal_e, t_a_sig_length_e) 
-            t_log_probs_e, t_encoded_len_e = encoderdecoder.infer((t_processed_signal,t_processed_signal_len))
+            # features stay in fp32, log_softmax autocasts its output back to fp32
+            with autocast(enabled=args.fp16 or args.bf16, dtype=amp_dtype):
+                t_log_probs_e, t_encoded_len_e = encoderdecoder.infer((t_processed_signal,t_processed_signal_len))
             t_predictions_e = greedy_decoder(t_log_probs_e)
-    
-            values_dict = dict(
-                predictions=[t_predictions_e],
-                transcript=[t_transcript_e],
-                transcript_length=[t_transcript_len_e],
-                output=[t_log_probs_e],
-                encoded_length=[t_encoded_len_e]
-            )
-            # values_dict will contain results from all workers
-            process_evaluation_batch(values_dict, _global_var_dict, labels=labels)    
+
+            predictions.append(t_predictions_e)
+            transcripts.append(t_transcript_e)
+            transcript_lens.append(t_transcript_len_e)
+            if keep_logits:
+                logits.append(t_log_probs_e)
+            encoded_lens.append(t_encoded_len_e)
             if args.steps is not None and it + 1 >= args.steps:
                 break
 
+        process_evaluation_batch(predictions, transcripts, transcript_lens, _global_var_dict, labels=labels,
+                                 logits=logits, encoded_length=encoded_lens)
+
+        if data_layer.sampler is not None and hasattr(data_layer.sampler, 'restore_order'):
+            # batches were grouped by duration, report per-utterance results in manifest order
+            for key in ('predictions', 'transcripts'):
+                _global_var_dict[key] = data_layer.sampler.restore_order(_global_var_dict[key])
+
         # final aggregation (over minibatches) and logging of results
         wer, cer, _ = process_evaluation_epoch(_global_var_dict)
         wer = wer*100
@@ -102,6 +268,34 @@ def calc_wer(data_layer, audio_processor,
         print("\n\n==========>>>>>>Evaluation Greedy CER: {:.2f}\n".format(cer))
         return wer, _global_var_dict
 
+def save_logits_memmap(path, logits, encoded_lens, sampler=None):
+    """writes per-utterance logits, cut to their encoded length, as a single float16 (sum of lengths, vocab)
+    np.memmap at `path`, and an int64 (utterances, 2) array of (offset, length) rows in .npy format at `path`.idx
+    Args:
+        path: output file
+        logits: list of [B, T, V] logits tensors, one per batch
+        encoded_lens: list of [B] encoded length tensors matching `logits`
+        sampler: batch sampler of the data layer, its restore_order() is used when it has one
+    """
+    utterances = []
+    for batch, lens in zip(logits, encoded_lens):
+        # one device-to-host copy per batch, rows are numpy views into it
+        batch = batch.to(torch.float16).cpu().numpy()
+        lens = lens.long().clamp(max=batch.shape[1]).cpu().tolist()
+        utterances.extend(batch[i, :n] for i, n in enumerate(lens))
+    if sampler is not None and hasattr(sampler, 'restore_order'):
+        utterances = sampler.restore_order(utterances)
+
+    lengths = np.array([u.shape[0] for u in utterances], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    blob = np.memmap(path, dtype=np.float16, mode='w+', shape=(max(int(lengths.sum()), 1), logits[0].shape[2]))
+    for u, offset in zip(utterances, offsets):
+        blob[offset:offset + u.shape[0]] = u
+    blob.flush()
+    del blob
+    with open(path + '.idx', 'wb') as f:
+        np.save(f, np.stack([offsets, lengths], axis=1))
+
 def eval(
          data_layer,
          audio_processor,
@@ -122,7 +316,7 @@ def eval(
     """
     logits_save_to=args.logits_save_to
     
-    with torch.no_grad():
+    with inference_mode():
         wer, _global_var_dict = calc_wer(data_layer, audio_processor, encoderdecoder, greedy_decoder, labels, args)
         if (not multi_gpu or (multi_gpu and torch.distributed.get_rank() == 0)):
             #print("==========>>>>>>Evaluation Greedy WER: {0}\n".format(wer))
@@ -130,11 +324,16 @@ def eval(
             if args.save_prediction is not None:
                 with open(args.save_prediction, 'w') as fp:
                     fp.write('\n'.join(_global_var_dict['predictions']))
-            if logits_save_to is not None:
+            if logits_save_to is not None and args.logits_memmap:
+                save_logits_memmap(logits_save_to, _global_var_dict["logits"], _global_var_dict["encoded_lens"],
+                                   sampler=data_layer.sampler)
+            elif logits_save_to is not None:
                 logits = []
                 for batch in _global_var_dict["logits"]:
-                    for i in range(batch.shape[0]):
-                        logits.append(batch[i].cpu().numpy())
+                    # one device-to-host copy per batch, rows are numpy views into it
+                    logits.extend(batch.cpu().numpy())
+                if data_layer.sampler is not None and hasattr(data_layer.sampler, 'restore_order'):
+                    logits = data_layer.sampler.restore_order(logits)
                 with open(logits_save_to, 'wb') as f:
                     pickle.dump(logits, f, protocol=pickle.HIGHEST_PROTOCOL)
 
@@ -150,6 +349,10 @@ def main(args):
     torch.manual_seed(args.seed)
     torch.backends.cudnn.benchmark = args.cudnn_benchmark
     print("CUDNN BENCHMARK ", args.cudnn_benchmark)
+    # TF32 tensor cores for convs and matmuls on Ampere+ (torch>=1.7)
+    if hasattr(torch.backends.cuda, 'matmul'):
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     assert(torch.cuda.is_available())
 
     if args.local_rank is not None:
@@ -159,10 +362,23 @@ def main(args):
     if multi_gpu:
         print("DISTRIBUTED with ", torch.distributed.get_world_size())
 
-    if args.fp16:
-        optim_level = 3
-    else:
-        optim_level = 0
+    if args.fp16 and not hasattr(torch.cuda, 'amp'):
+        raise ValueError("--fp16 needs native AMP (torch.cuda.amp, torch>=1.6)")
+    if args.bf16:
+        if args.fp16:
+            raise ValueError("--fp16 and --bf16 are mutually exclusive")
+        # bf16 keeps fp32's exponent range, but only Ampere (sm_80) and newer run it on tensor cores
+        if not hasattr(torch.cuda, 'is_bf16_supported') or not torch.cuda.is_bf16_supported() \
+                or torch.cuda.get_device_capability() < (8, 0):
+            raise ValueError("--bf16 needs a GPU with compute capability >= 8.0 and torch>=1.10")
+    if args.int8:
+        # the quantized model replaces the torch encoder/decoder altogether
+        if args.fp16 or args.bf16 or args.compile or args.cuda_graphs:
+            raise ValueError("--int8 can not be combined with --fp16, --bf16, --compile or --cuda_graphs")
+        try:
+            import onnxruntime.quantization
+        except ImportError:
+            raise ValueError("--int8 needs onnxruntime (with onnxruntime.quantization)")
 
     jasper_model_definition = toml.load(args.model_toml)
     dataset_vocab = jasper_model_definition['labels']['labels']
@@ -170,7 +386,6 @@ def main(args):
 
     val_manifest = args.val_manifest
     featurizer_config = jasper_model_definition['input_eval']
-    featurizer_config["optimization_level"] = optim_level
     featurizer_config["fp16"] = args.fp16
     args.use_conv_mask = jasper_model_definition['encoder'].get('convmask', True)
 
@@ -201,7 +416,11 @@ def main(args):
         batch_size=args.batch_size,
         pad_to_max=featurizer_config['pad_to'] == -1,
         shuffle=False,
-        multi_gpu=multi_gpu)
+        multi_gpu=multi_gpu,
+        # --steps evaluates a prefix of the manifest, keep manifest order for it
+        batch_by_duration=args.batch_by_duration and args.steps is None,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor)
     audio_preprocessor = AudioPreprocessing(**featurizer_config)
     encoderdecoder = JasperEncoderDecoder(jasper_model_definition=jasper_model_definition, feat_in=1024, num_classes=len(ctc_vocab))        
 
@@ -210,12 +429,18 @@ def main(args):
 
         if os.path.isdir(args.ckpt):
             exit(0)
-        else:
-            checkpoint = torch.load(args.ckpt, map_location="cpu")
-            for k in audio_preprocessor.state_dict().keys():
-                checkpoint['state_dict'][k] = checkpoint['state_dict'].pop("audio_preprocessor." + k)
-            audio_preprocessor.load_state_dict(checkpoint['state_dict'], strict=False)
-            encoderdecoder.load_state_dict(checkpoint['state_dict'], strict=False)
+        broadcast = multi_gpu and hasattr(torch.distributed, 'broadcast_object_list')
+        if not broadcast or torch.distributed.get_rank() == 0:
+            # tolerates preprocessor buffers the checkpoint predates, e.g. the spectrogram window
+            state_dict = strip_preprocessor_prefix(torch.load(args.ckpt, map_location="cpu")['state_dict'],
+                                                   audio_preprocessor)
+        if broadcast:
+            # read the checkpoint from disk once, the other ranks receive only the weights from rank 0 (torch>=1.8)
+            state_dict = [state_dict if torch.distributed.get_rank() == 0 else None]
+            torch.distributed.broadcast_object_list(state_dict, src=0)
+            state_dict = state_dict[0]
+        audio_preprocessor.load_state_dict(state_dict, strict=False)
+        encoderdecoder.load_state_dict(state_dict, strict=False)
     greedy_decoder = GreedyCTCDecoder()
 
     N = len(data_layer)
@@ -240,7 +465,30 @@ def main(args):
     audio_preprocessor.eval()
     encoderdecoder.eval()
     greedy_decoder.eval()
+
+    if args.compile:
+        if not hasattr(torch, 'compile'):
+            raise ValueError("--compile needs torch.compile (torch>=2.0)")
+        # compile the submodules, calc_wer goes through infer() which torch.compile(encoderdecoder)
+        # would not cover. dynamic shapes, the time dimension changes from batch to batch
+        model = encoderdecoder.module if hasattr(encoderdecoder, 'module') else encoderdecoder
+        model.jasper_encoder = torch.compile(model.jasper_encoder, dynamic=True)
+        model.jasper_decoder = torch.compile(model.jasper_decoder, dynamic=True)
     
+    if args.cuda_graphs:
+        if not hasattr(torch.cuda, 'CUDAGraph'):
+            raise ValueError("--cuda_graphs needs torch.cuda.CUDAGraph (torch>=1.10)")
+        if featurizer_config['pad_to'] >= 0 and featurizer_config['pad_to'] < 128:
+            print("WARNING: --cuda_graphs with pad_to={} captures a graph for almost every batch, "
+                  "pass a coarse --pad_to (e.g. 256) or -1".format(featurizer_config['pad_to']))
+        encoderdecoder = GraphedInfer(encoderdecoder.module if hasattr(encoderdecoder, 'module') else encoderdecoder,
+                                      max_graphs=args.cuda_graphs_max)
+
+    if args.int8:
+        print("calibrating and quantizing to int8 on {} batches".format(args.int8_calib_batches))
+        encoderdecoder = OnnxInt8Infer(encoderdecoder.module if hasattr(encoderdecoder, 'module') else encoderdecoder,
+                                       audio_preprocessor, data_layer, calib_batches=args.int8_calib_batches)
+
     eval(
         data_layer=data_layer,
         audio_processor=audio_preprocessor,
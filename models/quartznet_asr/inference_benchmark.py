@@ -26,7 +26,8 @@ import toml
 import torch
 from apex import amp
 from dataset import AudioToTextDataLayer
-from helpers import process_evaluation_batch, process_evaluation_epoch, add_ctc_labels, AmpOptimizations, print_dict
+from helpers import process_evaluation_batch, process_evaluation_epoch, add_ctc_labels, AmpOptimizations, print_dict, \
+                    strip_preprocessor_prefix
 from model import AudioPreprocessing, GreedyCTCDecoder, JasperEncoderDecoder
 
 def parse_args():
@@ -105,12 +106,8 @@ def eval(
                 time_dnn = stop_time - t1
                 t_predictions_e = greedy_decoder(log_probs=t_log_probs_e)
 
-                values_dict = dict(
-                    predictions=[t_predictions_e],
-                    transcript=[t_transcript_e],
-                    transcript_length=[t_transcript_len_e],
-                )
-                process_evaluation_batch(values_dict, _global_var_dict, labels=labels)
+                process_evaluation_batch(t_predictions_e, t_transcript_e, t_transcript_len_e, _global_var_dict,
+                                         labels=labels)
                 durations_dnn.append(time_dnn)
                 durations_dnn_and_prep.append(time_prep_and_dnn)
                 seq_lens.append(t_processed_signal[0].shape[-1])
@@ -202,8 +199,7 @@ def main(args):
     if args.ckpt is not None:
         print("loading model from ", args.ckpt)
         checkpoint = torch.load(args.ckpt, map_location="cpu")
-        for k in audio_preprocessor.state_dict().keys():
-            checkpoint['state_dict'][k] = checkpoint['state_dict'].pop("audio_preprocessor." + k)
+        checkpoint['state_dict'] = strip_preprocessor_prefix(checkpoint['state_dict'], audio_preprocessor)
         audio_preprocessor.load_state_dict(checkpoint['state_dict'], strict=False)
         encoderdecoder.load_state_dict(checkpoint['state_dict'], strict=False)
 
@@ -14,11 +14,18 @@
 
 from typing import List
 import Levenshtein as Lev
+try:
+    # optional, C implementation that also takes token lists
+    from rapidfuzz.distance import Levenshtein as RFLev
+except ImportError:
+    RFLev = None
 
 
 def __levenshtein(a: List, b: List) -> int:
     """Calculates the Levenshtein distance between a and b.
     """
+    if RFLev is not None:
+        return RFLev.distance(a, b)
     n, m = len(a), len(b)
     if n > m:
         # Make sure n <= m, to use O(min(n,m)) space
@@ -102,8 +109,9 @@ def word_error_rate(hypotheses: List[str], references: List[str], use_cer=False)
             h_list = h.split()
             r_list = r.split()
         words += len(r_list)
-        scores += __levenshtein(h_list, r_list)
-        wer_list.append((1.0*__levenshtein(h_list, r_list))/(len(r_list)+1e-20))
+        distance = __levenshtein(h_list, r_list)
+        scores += distance
+        wer_list.append((1.0*distance)/(len(r_list)+1e-20))
     if words != 0:
         wer = 1.0 * scores / words
     else:
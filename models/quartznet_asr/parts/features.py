@@ -145,7 +145,7 @@ class SpectrogramFeatures(nn.Module):
         window_fn = torch_windows.get(window, None)
         window_tensor = window_fn(self.win_length,
                                   periodic=False) if window_fn else None
-        self.window = window_tensor
+        self.register_buffer("window", window_tensor)
 
         self.normalize = normalize
         self.log = log
@@ -197,7 +197,7 @@ class SpectrogramFeatures(nn.Module):
 
         # mask to zero any values beyond seq_len in batch, pad to multiple of `pad_to` (for efficiency)
         max_len = x.size(-1)
-        mask = torch.arange(max_len, dtype=seq_len.dtype).to(seq_len.device).expand(x.size(0), max_len) >= seq_len.unsqueeze(1)
+        mask = torch.arange(max_len, dtype=seq_len.dtype, device=seq_len.device).expand(x.size(0), max_len) >= seq_len.unsqueeze(1)
         x = x.masked_fill(mask.unsqueeze(1).to(device=x.device), 0)
         
         # TORCHSCRIPT: Is this del important? It breaks scripting
@@ -320,8 +320,8 @@ class FilterbankFeatures(nn.Module):
 
         # mask to zero any values beyond seq_len in batch, pad to multiple of `pad_to` (for efficiency)
         max_len = x.size(-1)
-        mask = torch.arange(max_len, dtype=seq_len.dtype).to(x.device).expand(x.size(0),
-                                                                              max_len) >= seq_len.unsqueeze(1)
+        mask = torch.arange(max_len, dtype=seq_len.dtype, device=x.device).expand(x.size(0),
+                                                                                  max_len) >= seq_len.unsqueeze(1)
 
         x = x.masked_fill(mask.unsqueeze(1), 0)
         # TORCHSCRIPT: Is this del important? It breaks scripting
@@ -202,7 +202,7 @@ class NeMoManifest(object):
             # Turn all punctuation to whitespace
             table = str.maketrans(punctuation, " " * len(punctuation))
         for manifest_path in manifest_paths:
-            with open(manifest_path, "r") as fh:
+            with open(manifest_path, "r", encoding="utf-8") as fh:
                 for line in fh:
                     data = json.loads(line.strip())
                     if 'original_duration' in data:
@@ -238,6 +238,8 @@ class JasperEncoder(nn.Module):
 
         activation = jasper_activations[cfg['encoder']['activation']]()
         self.use_conv_mask = cfg['encoder'].get('convmask', False)
+        if not self.use_conv_mask:
+            raise ValueError("encoder convmask = false is not supported, the blocks only handle masked (signal, length) input")
         feat_in = cfg['input']['features'] * cfg['input'].get('frame_splicing', 1)
         init_mode = cfg.get('init_mode', 'xavier_uniform')
         turn_bn_eval = cfg.get('turn_bn_eval',True)
@@ -301,14 +303,10 @@ class JasperEncoder(nn.Module):
     def num_weights(self):
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
-    def forward(self, x):
-        if self.use_conv_mask:
-            audio_signal, length = x
-            return self.encoder(([audio_signal], length))
-        else:
-            print("Error, not yet handeled conv_mask_false for intervining layer")
-            exit(1)
-            return self.encoder([x])
+    def forward(self, x: Tuple[Tensor, Tensor]):
+        # convmask is checked in __init__, so there is a single (scriptable) masked path
+        audio_signal, length = x
+        return self.encoder(([audio_signal], length))
 
 class JasperDecoderForCTC(nn.Module):
     """Jasper decoder
@@ -326,7 +324,7 @@ class JasperDecoderForCTC(nn.Module):
     def num_weights(self):
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
-    def forward(self, encoder_output):
+    def forward(self, encoder_output: List[Tensor]):
         out = self.decoder_layers(encoder_output[-1]).transpose(1, 2)
         return nn.functional.log_softmax(out, dim=2)
 
@@ -427,7 +425,7 @@ class MaskedConv1d(nn.Module):
         if self.use_mask:
             lens = lens.to(dtype=torch.long)
             max_len = x.size(2)
-            mask = torch.arange(max_len).to(lens.device).expand(len(lens), max_len) >= lens.unsqueeze(1)
+            mask = torch.arange(max_len, device=lens.device).expand(lens.size(0), max_len) >= lens.unsqueeze(1)
             x = x.masked_fill(mask.unsqueeze(1).to(device=x.device), 0)
             # del mask
             lens = self.get_seq_len(lens)
@@ -0,0 +1,26 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from helpers import strip_preprocessor_prefix
+from quartznet_model import AudioPreprocessing
+
+SPECTROGRAM_CONFIG = dict(feat_type="logspect", sample_rate=16000, window_size=0.02, window_stride=0.01,
+                          n_fft=512, window="hann", normalize="per_feature")
+
+
+def test_spectrogram_checkpoint_without_window_loads():
+    preprocessor = AudioPreprocessing(**SPECTROGRAM_CONFIG)
+    # checkpoints saved before the spectrogram window became a buffer have no featurizer.window
+    state_dict = {"audio_preprocessor." + k: v for k, v in preprocessor.state_dict().items()
+                  if k != "featurizer.window"}
+    state_dict["jasper_encoder.encoder.0.conv.0.weight"] = torch.zeros(1)
+
+    renamed = strip_preprocessor_prefix(state_dict, preprocessor)
+
+    assert "jasper_encoder.encoder.0.conv.0.weight" in renamed
+    assert not any(k.startswith("audio_preprocessor.") for k in renamed)
+    missing, _ = preprocessor.load_state_dict(renamed, strict=False)
+    assert list(missing) == ["featurizer.window"]
@@ -6,7 +6,7 @@ seed_offset = int(sys.argv[2])
 
 #durations = []
 
-with open(json_path) as f:
+with open(json_path, encoding="utf-8") as f:
 	durations = [json.loads(line.strip())["duration"] 
 	            for line in f]
 	assert len(durations) > seed_offset